@@ -0,0 +1,71 @@
+import ast
+import os
+
+import pytest
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script.py"
+)
+
+
+def _script_source():
+    """
+    Returns the source of script.py with the notebook shell and magic
+    lines (`!pip ...`, `%matplotlib ...`, `x = !cmd`) replaced by `pass`.
+    """
+    lines = []
+    with open(SCRIPT_PATH) as script:
+        for line in script:
+            stripped = line.lstrip()
+            indent = line[:len(line) - len(stripped)]
+            if stripped.startswith(("!", "%")) or "= !" in stripped:
+                lines.append(indent + "pass\n")
+            else:
+                lines.append(line)
+    return "".join(lines)
+
+
+def _defined_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {target.id for target in node.targets if isinstance(target, ast.Name)}
+    return set()
+
+
+def _load_script(*names, **namespace):
+    """
+    Executes the top-level imports of script.py and the top-level
+    definitions (functions, classes and assignments) called `names`,
+    in the order of the script, without running the rest of it.
+
+    Imports that are unavailable are skipped. `namespace` provides the
+    globals the definitions need (e.g. `device` or `volume_extent_world`)
+    and overrides imported names (e.g. the notebook `tqdm`).
+
+    Returns:
+        The namespace the definitions were executed in.
+    """
+    module = ast.parse(_script_source(), filename=SCRIPT_PATH)
+    overrides = namespace
+    namespace = {"__name__": "script", "__file__": SCRIPT_PATH}
+    for node in module.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            try:
+                exec(compile(ast.Module([node], []), SCRIPT_PATH, "exec"), namespace)
+            except ImportError:
+                pass
+    namespace.update(overrides)
+    missing = set(names)
+    for node in module.body:
+        if _defined_names(node) & set(names):
+            exec(compile(ast.Module([node], []), SCRIPT_PATH, "exec"), namespace)
+            missing -= _defined_names(node)
+    if missing:
+        raise LookupError(f"Not defined in script.py: {sorted(missing)}")
+    return namespace
+
+
+@pytest.fixture
+def load_script():
+    return _load_script
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+class _Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(2, 1)
+        self.lengths = self.xys = self.directions = None
+
+
+def _load(load_script):
+    return load_script(
+        "_checkpoint_dict", "checkpoint_paths", "_snapshot_to_cpu", "CheckpointManager"
+    )
+
+
+def _touch(path):
+    with open(path, "w"):
+        pass
+
+
+def test_checkpoint_paths_lists_checkpoints_newest_first(load_script, tmp_path):
+    script = _load(load_script)
+    for name in (
+        "checkpoint_epoch_100.pth", "checkpoint_epoch_2000.pth", "checkpoint_epoch_300.pth",
+        "checkpoint_epoch_400.pth.tmp", "checkpoint_epoch_x.pth", "model.pth",
+    ):
+        _touch(tmp_path / name)
+    assert [os.path.basename(path) for path in script["checkpoint_paths"](str(tmp_path))] == [
+        "checkpoint_epoch_2000.pth", "checkpoint_epoch_300.pth", "checkpoint_epoch_100.pth",
+    ]
+    assert script["checkpoint_paths"](str(tmp_path / "missing")) == []
+
+
+def test_snapshot_to_cpu_copies_nested_tensors(load_script):
+    script = _load(load_script)
+    weight = torch.ones(3, requires_grad=True)
+    value = {"a": [weight, (torch.zeros(2), 1)], "b": "text", "c": 2.5}
+    snapshot = script["_snapshot_to_cpu"](value)
+    assert isinstance(snapshot["a"], list) and isinstance(snapshot["a"][1], tuple)
+    assert snapshot["b"] == "text" and snapshot["c"] == 2.5 and snapshot["a"][1][1] == 1
+    assert not snapshot["a"][0].requires_grad
+    with torch.no_grad():
+        weight.add_(1.0)
+    assert snapshot["a"][0].tolist() == [1.0, 1.0, 1.0]
+
+
+def _save_all(manager, model, optimizer, losses):
+    for epoch, loss in losses:
+        manager.save(model, optimizer, epoch, loss)
+    manager.close()
+
+
+def test_checkpoint_manager_keeps_the_last_and_the_best(load_script, tmp_path):
+    script = _load(load_script)
+    model = _Model()
+    optimizer = torch.optim.Adam(model.parameters())
+    manager = script["CheckpointManager"](str(tmp_path), keep_last=2)
+    _save_all(manager, model, optimizer, [(100, 0.5), (200, 0.1), (300, 0.4), (400, 0.3), (500, 0.2)])
+    kept = [os.path.basename(path) for path in script["checkpoint_paths"](str(tmp_path))]
+    assert kept == ["checkpoint_epoch_500.pth", "checkpoint_epoch_400.pth", "checkpoint_epoch_200.pth"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    checkpoint = torch.load(str(tmp_path / "checkpoint_epoch_200.pth"))
+    assert checkpoint["epoch"] == 200 and checkpoint["loss"] == 0.1
+
+
+def test_checkpoint_manager_continues_the_retention_of_earlier_runs(load_script, tmp_path):
+    script = _load(load_script)
+    model = _Model()
+    optimizer = torch.optim.Adam(model.parameters())
+    manager = script["CheckpointManager"](str(tmp_path), keep_last=2)
+    _save_all(manager, model, optimizer, [(100, 0.1), (200, 0.5), (300, 0.4)])
+    _touch(tmp_path / "checkpoint_epoch_50.pth")
+
+    resumed = script["CheckpointManager"](str(tmp_path), keep_last=2)
+    assert resumed.best[1] == str(tmp_path / "checkpoint_epoch_100.pth")
+    _save_all(resumed, model, optimizer, [(400, 0.3), (500, 0.2)])
+    kept = [os.path.basename(path) for path in script["checkpoint_paths"](str(tmp_path))]
+    # The unreadable checkpoint is left alone.
+    assert kept == [
+        "checkpoint_epoch_500.pth", "checkpoint_epoch_400.pth",
+        "checkpoint_epoch_100.pth", "checkpoint_epoch_50.pth",
+    ]
+
+
+def test_checkpoint_manager_removes_incomplete_checkpoints(load_script, tmp_path):
+    script = _load(load_script)
+    model = _Model()
+    optimizer = torch.optim.Adam(model.parameters())
+    _touch(tmp_path / "checkpoint_epoch_50.pth.tmp")
+    # The rename onto a directory fails after the temporary file is written.
+    os.mkdir(tmp_path / "checkpoint_epoch_100.pth")
+
+    manager = script["CheckpointManager"](str(tmp_path))
+    assert not (tmp_path / "checkpoint_epoch_50.pth.tmp").exists()
+    manager.save(model, optimizer, 100, 0.5)
+    with pytest.raises(RuntimeError, match="Writing a checkpoint failed"):
+        manager.close()
+    assert sorted(os.listdir(tmp_path)) == ["checkpoint_epoch_100.pth"]
+
+
+def test_checkpoint_manager_close_can_only_report_a_failed_write(load_script, tmp_path):
+    script = _load(load_script)
+    model = _Model()
+    optimizer = torch.optim.Adam(model.parameters())
+    os.mkdir(tmp_path / "checkpoint_epoch_100.pth")
+
+    manager = script["CheckpointManager"](str(tmp_path))
+    manager.save(model, optimizer, 100, 0.5)
+    manager.close(raise_error=False)
+    assert manager.error is None
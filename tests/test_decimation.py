@@ -0,0 +1,102 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def _load(load_script):
+    return load_script(
+        "_collapse_targets", "_triangle_normals", "_EdgeCollapseDecimator", "decimate_mesh"
+    )
+
+
+def _grid_mesh(n):
+    """
+    A flat `n` x `n` grid of quads in the z = 0 plane, split into triangles.
+    """
+    x, y = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij")
+    vertices = np.stack((x, y, np.zeros_like(x)), axis=-1).reshape(-1, 3).astype(np.float32)
+    index = np.arange((n + 1) ** 2).reshape(n + 1, n + 1)
+    a, b = index[:-1, :-1].ravel(), index[1:, :-1].ravel()
+    c, d = index[1:, 1:].ravel(), index[:-1, 1:].ravel()
+    faces = np.concatenate((np.stack((a, b, c), axis=1), np.stack((a, c, d), axis=1)))
+    return vertices, faces
+
+
+def _sphere_mesh(n_lat=12, n_lon=24):
+    """
+    A closed UV sphere of radius 1.
+    """
+    theta = np.linspace(0, np.pi, n_lat + 1)[1:-1]
+    phi = np.linspace(0, 2 * np.pi, n_lon, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing="ij")
+    ring = np.stack((np.sin(t) * np.cos(p), np.sin(t) * np.sin(p), np.cos(t)), axis=-1)
+    vertices = np.concatenate(([[0, 0, 1]], ring.reshape(-1, 3), [[0, 0, -1]])).astype(np.float32)
+    south = len(vertices) - 1
+    faces = []
+    for j in range(n_lon):
+        k = (j + 1) % n_lon
+        faces.append((0, 1 + j, 1 + k))
+        for i in range(n_lat - 2):
+            a, b = 1 + i * n_lon + j, 1 + i * n_lon + k
+            c, d = a + n_lon, b + n_lon
+            faces += [(a, c, d), (a, d, b)]
+        base = 1 + (n_lat - 2) * n_lon
+        faces.append((base + j, south, base + k))
+    return vertices, np.array(faces)
+
+
+def test_collapse_targets_of_flat_region_have_zero_error(load_script):
+    script = _load(load_script)
+    plane = np.array([0.0, 0.0, 1.0, 0.0])
+    quadrics = np.broadcast_to(plane[:, None] * plane[None, :], (2, 4, 4))
+    p0 = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 0.0]])
+    p1 = np.array([[1.0, 0.0, 0.0], [2.0, 1.0, 0.0]])
+    targets, errors = script["_collapse_targets"](quadrics, p0, p1)
+    np.testing.assert_allclose(errors, 0.0, atol=1e-12)
+    np.testing.assert_allclose(targets[:, 2], 0.0, atol=1e-12)
+
+
+def test_decimate_flat_grid_keeps_plane_and_reaches_ratio(load_script):
+    script = _load(load_script)
+    vertices, faces = _grid_mesh(8)
+    levels = script["decimate_mesh"](vertices, faces, ratios=(1.0, 0.25))
+    assert len(levels[0]["faces"]) == len(faces)
+    assert len(levels[1]["faces"]) <= round(0.25 * len(faces))
+    np.testing.assert_allclose(levels[1]["vertices"][:, 2], 0.0, atol=1e-6)
+    assert levels[1]["faces"].max() < len(levels[1]["vertices"])
+
+
+def test_decimate_sphere_stays_close_to_surface_and_closed(load_script):
+    script = _load(load_script)
+    vertices, faces = _sphere_mesh()
+    (level,) = script["decimate_mesh"](vertices, faces, ratios=(0.3,))
+    assert len(level["faces"]) <= round(0.3 * len(faces))
+    radii = np.linalg.norm(level["vertices"], axis=-1)
+    assert np.abs(radii - 1.0).max() < 0.1
+    # Every edge of a closed manifold mesh is shared by exactly two faces.
+    edges = np.sort(level["faces"][:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    assert (counts == 2).all()
+
+
+def test_decimate_with_max_error_stops_early(load_script):
+    script = _load(load_script)
+    vertices, faces = _sphere_mesh()
+    (level,) = script["decimate_mesh"](vertices, faces, ratios=(0.05,), max_error=0.0)
+    assert len(level["faces"]) > round(0.05 * len(faces))
+
+
+def test_decimate_open_sheet_keeps_its_border(load_script):
+    script = _load(load_script)
+    vertices, faces = _grid_mesh(32)
+    vertices[:, 2] = 0.3 * np.sin(vertices[:, 0] / 6) * np.cos(vertices[:, 1] / 9)
+    (level,) = script["decimate_mesh"](vertices, faces, ratios=(0.05,))
+    assert len(level["faces"]) <= round(0.05 * len(faces))
+    np.testing.assert_allclose(level["vertices"][:, :2].min(axis=0), 0.0, atol=0.01)
+    np.testing.assert_allclose(level["vertices"][:, :2].max(axis=0), 32.0, atol=0.01)
+    # The border vertices stay on the sides of the square.
+    edges = np.sort(level["faces"][:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    border = level["vertices"][np.unique(edges[counts == 1])][:, :2]
+    distance_to_side = np.minimum(border, 32.0 - border).min(axis=1)
+    assert distance_to_side.max() < 0.01
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from test_density_volume import _Progress
+
+
+class _SphereField(torch.nn.Linear):
+    def __init__(self):
+        super().__init__(1, 1)
+
+    def query_density(self, points, chunk_size=65536):
+        return (points.norm(dim=-1, keepdim=True) < 0.5).float()
+
+
+class _FailingField(_SphereField):
+    def query_density(self, points, chunk_size=65536):
+        raise KeyboardInterrupt
+
+
+def _load(load_script, tmp_path):
+    return load_script(
+        "evaluate_point_densities",
+        "evaluate_density_volume",
+        "state_dict_digest",
+        "_read_density_cache_entries",
+        "_write_density_cache_meta",
+        "evict_density_cache",
+        "load_or_evaluate_density_volume",
+        device=torch.device("cpu"),
+        tqdm=lambda iterable, **kwargs: _Progress(iterable),
+        DENSITY_CACHE_DIR=str(tmp_path),
+    )
+
+
+def test_density_cache_reuses_the_cached_volume(load_script, tmp_path):
+    script = _load(load_script, tmp_path)
+    field = _SphereField()
+    volume = script["load_or_evaluate_density_volume"](field, grid_resolution=8, cache_dir=str(tmp_path))
+    cached = script["load_or_evaluate_density_volume"](field, grid_resolution=8, cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(volume, cached)
+    assert sorted(name.rsplit(".", 1)[1] for name in os.listdir(tmp_path)) == ["json", "npy"]
+
+
+def test_interrupted_evaluation_leaves_no_volume_behind(load_script, tmp_path):
+    script = _load(load_script, tmp_path)
+    with pytest.raises(KeyboardInterrupt):
+        script["load_or_evaluate_density_volume"](
+            _FailingField(), grid_resolution=8, cache_dir=str(tmp_path)
+        )
+    assert os.listdir(tmp_path) == []
+
+
+def test_evict_density_cache_removes_incomplete_volumes(load_script, tmp_path):
+    script = _load(load_script, tmp_path)
+    np.save(str(tmp_path / "orphan.tmp.npy"), np.zeros((4, 4, 4), dtype=np.float32))
+    script["evict_density_cache"](str(tmp_path))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,42 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+
+class _Progress(list):
+    def set_postfix(self, **kwargs):
+        pass
+
+
+class _SphereField:
+    def query_density(self, points, chunk_size=65536):
+        return (points.norm(dim=-1, keepdim=True) < 0.5).float()
+
+
+def _load(load_script):
+    return load_script(
+        "evaluate_point_densities",
+        "evaluate_density_volume",
+        device=torch.device("cpu"),
+        tqdm=lambda iterable, **kwargs: _Progress(iterable),
+    )
+
+
+def test_evaluate_density_volume_fills_out(load_script):
+    script = _load(load_script)
+    out = np.full((8, 8, 8), -1.0, dtype=np.float32)
+    result = script["evaluate_density_volume"](
+        _SphereField(), grid_resolution=8, slab_size=3, chunk_size=50, out=out
+    )
+    assert result is out
+    axis = np.linspace(-1.0, 1.0, 8)
+    x, y, z = np.meshgrid(axis, axis, axis, indexing="ij")
+    np.testing.assert_array_equal(out, (np.sqrt(x**2 + y**2 + z**2) < 0.5).astype(np.float32))
+
+
+def test_evaluate_density_volume_rejects_non_contiguous_out(load_script):
+    script = _load(load_script)
+    out = np.zeros((8, 8, 8), dtype=np.float32).transpose(2, 1, 0)
+    with pytest.raises(ValueError, match="contiguous"):
+        script["evaluate_density_volume"](_SphereField(), grid_resolution=8, out=out)
@@ -0,0 +1,50 @@
+import collections
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+RayBundle = collections.namedtuple("RayBundle", ["origins", "directions", "lengths", "xys"])
+
+
+def _ray_bundle(n_rays=64, n_pts_per_ray=100):
+    generator = torch.Generator().manual_seed(0)
+    origins = torch.tensor([[0.0, 0.0, -2.0]]).expand(n_rays, 3)
+    directions = torch.nn.functional.normalize(
+        torch.cat((torch.rand(n_rays, 2, generator=generator) - 0.5, torch.ones(n_rays, 1)), dim=-1),
+        dim=-1,
+    )
+    lengths = torch.linspace(0.1, 4.0, n_pts_per_ray).expand(n_rays, n_pts_per_ray)
+    return RayBundle(origins, directions, lengths, None)
+
+
+def _sphere_field(ray_bundle, **kwargs):
+    points = ray_bundle.origins[..., None, :] + ray_bundle.lengths[..., None] * ray_bundle.directions[..., None, :]
+    densities = (points.norm(dim=-1, keepdim=True) < 0.8).float() * 0.3
+    colors = torch.sigmoid(points * 3.0)
+    return densities, colors
+
+
+def _emission_absorption(rays_densities, rays_features, eps=1e-10):
+    densities = rays_densities[..., 0]
+    absorption = torch.cumprod(1.0 + eps - densities, dim=-1)
+    absorption = torch.cat((torch.ones_like(absorption[..., :1]), absorption[..., :-1]), dim=-1)
+    features = ((densities * absorption)[..., None] * rays_features).sum(dim=-2)
+    opacities = 1.0 - torch.prod(1.0 - densities, dim=-1, keepdim=True)
+    return torch.cat((features, opacities), dim=-1)
+
+
+@pytest.mark.parametrize("opacity_threshold", [1.0, 0.99, 0.9])
+def test_early_termination_renderer_matches_the_full_render(load_script, opacity_threshold):
+    script = load_script("EarlyTerminationRenderer", RayBundle=RayBundle)
+    ray_bundle = _ray_bundle()
+    renderer = script["EarlyTerminationRenderer"](
+        lambda cameras, **kwargs: ray_bundle, chunk_size=16, opacity_threshold=opacity_threshold
+    )
+    images, _ = renderer(cameras=None, volumetric_function=_sphere_field)
+    expected = _emission_absorption(*_sphere_field(ray_bundle))
+    torch.testing.assert_close(
+        images, expected, rtol=0.0, atol=max(1.0 - opacity_threshold, 1e-5)
+    )
+    if opacity_threshold < 1.0:
+        assert renderer.n_evaluated_samples < ray_bundle.lengths.numel()
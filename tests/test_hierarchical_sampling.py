@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def test_sample_pdf_deterministic_uniform_weights_gives_evenly_spaced_samples(load_script):
+    script = load_script("sample_pdf")
+    bins = torch.linspace(0.0, 1.0, 5).expand(3, 5)
+    samples = script["sample_pdf"](bins, torch.ones(3, 4), 9, deterministic=True)
+    torch.testing.assert_close(samples, torch.linspace(0.0, 1.0, 9).expand(3, 9))
+
+
+def test_sample_pdf_puts_the_samples_in_the_weighted_bins(load_script):
+    script = load_script("sample_pdf")
+    torch.manual_seed(0)
+    bins = torch.linspace(0.0, 4.0, 5).expand(2, 5)
+    weights = torch.tensor([[0.0, 0.0, 1.0, 0.0], [1.0, 0.0, 0.0, 1.0]])
+    samples = script["sample_pdf"](bins, weights, 1000)
+    assert samples.shape == (2, 1000)
+    assert ((samples[0] >= 2.0) & (samples[0] <= 3.0)).float().mean() > 0.99
+    in_first = (samples[1] <= 1.0).float().mean()
+    in_last = (samples[1] >= 3.0).float().mean()
+    assert in_first + in_last > 0.99
+    assert abs(float(in_first) - 0.5) < 0.1
+    samples = script["sample_pdf"](bins, weights, 16, deterministic=True)
+    assert (samples[..., 1:] >= samples[..., :-1]).all()
+
+
+def test_rescale_densities_matches_the_reference_spacing(load_script):
+    script = load_script("rescale_densities")
+    opacities = torch.tensor([[0.1, 0.5, 0.9, 1.0]])[..., None]
+    lengths = torch.tensor([[0.0, 0.5, 1.0, 1.5]])
+    torch.testing.assert_close(
+        script["rescale_densities"](opacities, lengths, 0.5)[..., 0],
+        torch.tensor([[0.1, 0.5, 0.9, 1.0]]),
+    )
+    # Samples twice as far apart as the reference composite like two samples.
+    lengths = torch.tensor([[0.0, 1.0, 2.0, 3.0]])
+    rescaled = script["rescale_densities"](opacities, lengths, 0.5)[..., 0]
+    torch.testing.assert_close(rescaled[:, :3], 1.0 - (1.0 - opacities[:, :3, 0]) ** 2)
+    # The last sample stands for the reference spacing.
+    torch.testing.assert_close(rescaled[:, 3], torch.tensor([1.0]), atol=1e-5, rtol=0.0)
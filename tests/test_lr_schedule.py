@@ -0,0 +1,61 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def _schedule(load_script, *args, **kwargs):
+    script = load_script("LearningRateSchedule")
+    return script["LearningRateSchedule"](*args, **kwargs)
+
+
+def test_step_schedule_decays_at_the_milestones(load_script):
+    schedule = _schedule(load_script, 1e-3, n_iter=100)
+    assert schedule.lr_at(0) == 1e-3
+    assert schedule.lr_at(74) == 1e-3
+    assert schedule.lr_at(75) == pytest.approx(1e-4)
+    schedule = _schedule(load_script, 1.0, milestones=[10, 20], gamma=0.5)
+    assert [schedule.lr_at(i) for i in (9, 10, 19, 20, 1000)] == [1.0, 0.5, 0.5, 0.25, 0.25]
+
+
+@pytest.mark.parametrize("kind", ["exponential", "cosine"])
+def test_smooth_schedules_decay_from_base_lr_to_base_lr_times_gamma(load_script, kind):
+    schedule = _schedule(load_script, 1.0, kind=kind, n_iter=100, gamma=0.01)
+    lrs = [schedule.lr_at(i) for i in range(0, 151)]
+    assert lrs[0] == pytest.approx(1.0)
+    assert lrs[100] == pytest.approx(0.01)
+    assert lrs[150] == pytest.approx(0.01)
+    assert all(a >= b for a, b in zip(lrs, lrs[1:]))
+
+
+def test_schedule_midpoints(load_script):
+    exponential = _schedule(load_script, 1.0, kind="exponential", n_iter=100, gamma=0.01)
+    assert exponential.lr_at(50) == pytest.approx(0.1)
+    cosine = _schedule(load_script, 1.0, kind="cosine", n_iter=100, gamma=0.0)
+    assert cosine.lr_at(50) == pytest.approx(0.5)
+    assert cosine.lr_at(25) == pytest.approx(0.5 * (1 + math.cos(math.pi / 4)))
+
+
+def test_warmup_ramps_up_linearly_before_the_schedule(load_script):
+    schedule = _schedule(load_script, 1.0, kind="cosine", n_iter=110, warmup_iters=10, gamma=0.0)
+    assert [schedule.lr_at(i) for i in range(10)] == pytest.approx([(i + 1) / 10 for i in range(10)])
+    assert schedule.lr_at(10) == pytest.approx(1.0)
+    assert schedule.lr_at(60) == pytest.approx(0.5)
+
+
+def test_step_sets_the_lr_in_place_and_state_round_trips(load_script):
+    schedule = _schedule(load_script, 1.0, milestones=[5])
+    parameter = torch.nn.Parameter(torch.zeros(1))
+    optimizer = torch.optim.Adam([parameter, torch.nn.Parameter(torch.zeros(1))], lr=1.0)
+    assert schedule.step(optimizer, 5) == pytest.approx(0.1)
+    assert [group["lr"] for group in optimizer.param_groups] == pytest.approx([0.1])
+    restored = _schedule(load_script, 2.0, kind="cosine")
+    restored.load_state_dict(schedule.state_dict())
+    assert restored.lr_at(7) == schedule.lr_at(7)
+    assert restored.last_iteration == 5
+
+
+def test_unknown_kind_raises(load_script):
+    with pytest.raises(ValueError, match="Unknown"):
+        _schedule(load_script, 1.0, kind="linear")
@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+class _SphereField:
+    def query_density(self, points, chunk_size=65536):
+        return (points.norm(dim=-1, keepdim=True) < 0.5).float()
+
+
+class _EmptyField:
+    def query_density(self, points, chunk_size=65536):
+        return points.new_zeros(*points.shape[:-1], 1)
+
+
+def _occupancy_grid(load_script, **kwargs):
+    script = load_script("OccupancyGrid", volume_extent_world=2.0)
+    return script["OccupancyGrid"](resolution=8, **kwargs)
+
+
+def test_occupancy_grid_is_occupied_everywhere_before_the_first_update(load_script):
+    grid = _occupancy_grid(load_script)
+    points = torch.tensor([[0.0, 0.0, 0.0], [0.9, 0.9, 0.9], [3.0, 0.0, 0.0]])
+    assert grid.is_occupied(points).all()
+
+
+def test_occupancy_grid_is_occupied_after_update(load_script):
+    grid = _occupancy_grid(load_script)
+    grid.update(_SphereField())
+    points = torch.tensor(
+        [[[0.0, 0.0, 0.0], [0.9, 0.9, 0.9]], [[-0.9, 0.0, 0.0], [3.0, 0.0, 0.0]]]
+    )
+    occupied = grid.is_occupied(points)
+    assert occupied.shape == (2, 2)
+    # The center cells are occupied, the corner cells and points outside
+    # the grid are empty.
+    assert occupied.tolist() == [[True, False], [False, False]]
+
+
+def test_occupancy_grid_cells_fade_out_after_several_updates(load_script):
+    grid = _occupancy_grid(load_script, decay=0.5, threshold=0.2)
+    grid.update(_SphereField())
+    center = torch.zeros(1, 3)
+    empty_field = _EmptyField()
+    grid.update(empty_field)
+    grid.update(empty_field)
+    assert grid.is_occupied(center).all()
+    grid.update(empty_field)
+    assert not grid.is_occupied(center).any()
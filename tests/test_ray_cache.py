@@ -0,0 +1,72 @@
+import collections
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+RayBundle = collections.namedtuple("RayBundle", ["origins", "directions", "lengths", "xys"])
+
+
+class _PixelRaysampler:
+    def __init__(self, image_height, image_width, n_pts_per_ray, min_depth, max_depth):
+        self.image_height = image_height
+        self.image_width = image_width
+
+    def to(self, device):
+        return self
+
+    def __call__(self, cameras):
+        n_views = cameras.shape[0]
+        shape = (n_views, self.image_height, self.image_width)
+        origins = cameras[:, None, None, :].expand(*shape, 3)
+        directions = torch.randn(*shape, 3, generator=torch.Generator().manual_seed(0))
+        xys = torch.zeros(*shape, 2)
+        return RayBundle(origins, directions, None, xys)
+
+
+def _ray_cache(load_script, **kwargs):
+    script = load_script(
+        "TrainingRayCache",
+        "PooledRayCache",
+        RayBundle=RayBundle,
+        NDCMultinomialRaysampler=_PixelRaysampler,
+        volume_extent_world=3.0,
+    )
+    cameras = torch.arange(6.0).reshape(2, 3)
+    images = torch.rand(2, 4, 4, 3)
+    silhouettes = torch.rand(2, 4, 4)
+    return lambda: script["PooledRayCache"](
+        cameras, images, silhouettes, n_rays_per_step=12, seed=3, n_pts_per_ray=4, **kwargs
+    )
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_pooled_ray_cache_resumes_from_its_extra_state(load_script, shuffle):
+    make_cache = _ray_cache(load_script, shuffle=shuffle)
+    ray_cache = make_cache()
+    for _ in range(2):
+        ray_cache()
+    state = ray_cache.get_extra_state()
+    expected = []
+    for _ in range(3):
+        ray_cache()
+        expected.append(ray_cache.pixel_idx)
+
+    resumed = make_cache()
+    resumed.set_extra_state(state)
+    for pixel_idx in expected:
+        resumed()
+        torch.testing.assert_close(resumed.pixel_idx, pixel_idx)
+
+
+def test_pooled_ray_cache_visits_every_pixel_once_per_epoch(load_script):
+    ray_cache = _ray_cache(load_script)()
+    batches = []
+    for _ in range(8):
+        ray_cache()
+        batches.append(ray_cache.pixel_idx[0])
+    pixel_idx = torch.cat(batches)
+    for epoch in pixel_idx.split(32):
+        assert sorted(epoch.tolist()) == list(range(32))
+    assert ray_cache.epoch == 2
+    assert "_extra_state" in ray_cache.state_dict()
@@ -0,0 +1,61 @@
+import collections
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+RayBundle = collections.namedtuple("RayBundle", ["origins", "directions", "lengths", "xys"])
+
+
+def _load(load_script):
+    return load_script(
+        "_SH_C0",
+        "_SH_C1",
+        "_SH_C2",
+        "spherical_harmonics_basis",
+        "SparseVoxelRadianceField",
+        RayBundle=RayBundle,
+    )
+
+
+def _sparse_grid(block_index, density=1.0):
+    n_occupied = int((block_index >= 0).sum())
+    return {
+        "grid_resolution": block_index.shape[0] * 2 + 1,
+        "block_size": 2,
+        "sh_degree": 0,
+        "bounds": np.array([-1.0, 1.0], dtype=np.float32),
+        "block_index": block_index,
+        "densities": np.full((n_occupied, 3, 3, 3), density, dtype=np.float16),
+        "sh_coefficients": np.full((n_occupied, 3, 3, 3, 3, 1), 1.0, dtype=np.float16),
+    }
+
+
+def _ray_bundle(n_rays=4, n_pts_per_ray=8):
+    origins = torch.tensor([[0.0, 0.0, -2.0]]).expand(n_rays, 3)
+    directions = torch.tensor([[0.0, 0.0, 1.0]]).expand(n_rays, 3)
+    lengths = torch.linspace(0.5, 3.5, n_pts_per_ray).expand(n_rays, n_pts_per_ray)
+    return RayBundle(origins, directions, lengths, None)
+
+
+def test_sparse_voxel_radiance_field_without_blocks_is_empty(load_script):
+    script = _load(load_script)
+    block_index = np.full((2, 2, 2), -1, dtype=np.int32)
+    field = script["SparseVoxelRadianceField"](_sparse_grid(block_index))
+    densities, colors = field(_ray_bundle())
+    assert densities.shape == (4, 8, 1) and colors.shape == (4, 8, 3)
+    assert not densities.any() and not colors.any()
+
+
+def test_sparse_voxel_radiance_field_looks_up_kept_blocks(load_script):
+    script = _load(load_script)
+    block_index = np.full((2, 2, 2), -1, dtype=np.int32)
+    block_index[1, 1, 1] = 0
+    field = script["SparseVoxelRadianceField"](_sparse_grid(block_index, density=0.5))
+    densities, _ = field(_ray_bundle())
+    # The rays run along the z axis through the corner of the kept block
+    # at (0, 0, 0), and only the points with 0 <= z <= 1 are inside it.
+    z = _ray_bundle().lengths[0] - 2.0
+    expected = torch.where((z >= 0) & (z <= 1), 0.5, 0.0)
+    torch.testing.assert_close(densities[0, :, 0], expected)
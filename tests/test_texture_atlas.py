@@ -0,0 +1,114 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("scipy")
+
+from test_decimation import _grid_mesh, _sphere_mesh
+
+
+def _load(load_script, **namespace):
+    return load_script(
+        "_triangle_normals", "_box_projection_charts", "_pack_atlas_charts",
+        "_format_rows", "save_textured_obj", "voxel_to_world", "evaluate_point_colors",
+        "bake_texture_atlas", **namespace,
+    )
+
+
+def _cube_mesh():
+    vertices = np.array(
+        [[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float32
+    )
+    quads = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    faces = np.array([tri for a, b, c, d in quads for tri in ((a, b, c), (a, c, d))])
+    return vertices, faces
+
+
+class _Mesh:
+    def __init__(self, vertices, faces):
+        self.vertices, self.faces = torch.as_tensor(vertices), torch.as_tensor(faces)
+
+    def verts_packed(self):
+        return self.vertices
+
+    def faces_packed(self):
+        return self.faces
+
+
+class _PositionColorField:
+    """
+    A stand-in for the NeRF whose color at a point is its world position.
+    """
+
+    def _get_features(self, points):
+        return points
+
+    def _get_colors(self, features, directions):
+        return features
+
+
+def test_box_projection_charts_keep_connected_sides_together(load_script):
+    script = _load(load_script)
+    chart_ids, coords = script["_box_projection_charts"](*_cube_mesh())
+    assert len(np.unique(chart_ids)) == 6
+    assert (chart_ids[0::2] == chart_ids[1::2]).all()
+
+    # A flat sheet is a single chart, projected without distortion.
+    vertices, faces = _grid_mesh(8)
+    chart_ids, coords = script["_box_projection_charts"](vertices, faces)
+    assert (chart_ids == 0).all()
+    np.testing.assert_allclose(np.abs(coords), vertices[faces][..., :2])
+
+
+def test_packed_charts_do_not_overlap_and_share_the_texel_density(load_script):
+    script = _load(load_script)
+    vertices, faces = _sphere_mesh()
+    chart_ids, coords = script["_box_projection_charts"](vertices, faces)
+    uvs, texels_per_unit = script["_pack_atlas_charts"](chart_ids, coords, 256, padding=2)
+
+    # Each chart is placed by a translation at the common density.
+    for chart in np.unique(chart_ids):
+        offsets = uvs[chart_ids == chart] - coords[chart_ids == chart] * texels_per_unit
+        np.testing.assert_allclose(offsets - offsets[0, 0], 0.0, atol=1e-6)
+
+    # The charts and their gutters are disjoint and inside the texture.
+    boxes = [
+        (uvs[chart_ids == chart].reshape(-1, 2).min(axis=0) - 2.5,
+         uvs[chart_ids == chart].reshape(-1, 2).max(axis=0) + 2.5)
+        for chart in np.unique(chart_ids)
+    ]
+    for i, (low, high) in enumerate(boxes):
+        assert (low >= -1e-6).all() and (high <= 256 + 1e-6).all()
+        for other_low, other_high in boxes[:i]:
+            assert ((high <= other_low + 1e-6) | (other_high <= low + 1e-6)).any()
+
+
+def test_pack_atlas_charts_raises_if_the_charts_cannot_fit(load_script):
+    script = _load(load_script)
+    chart_ids, coords = script["_box_projection_charts"](*_sphere_mesh())
+    with pytest.raises(ValueError, match="too small"):
+        script["_pack_atlas_charts"](chart_ids, coords, 8, padding=2)
+
+
+def test_bake_texture_atlas_samples_the_surface(load_script, tmp_path):
+    script = _load(load_script, device="cpu")
+    vertices, faces = _sphere_mesh()
+    # The sphere in voxel coordinates of a 33^3 grid, i.e. radius 0.5 in world units.
+    mesh = _Mesh(vertices * 8.0 + 16.0, faces)
+    file_path = str(tmp_path / "sphere.obj")
+    texture = script["bake_texture_atlas"](
+        _PositionColorField(), mesh, grid_resolution=33, file_path=file_path,
+        texture_size=256, chunk_size=4096,
+    )
+    assert {path.name for path in tmp_path.iterdir()} == {"sphere.obj", "sphere.mtl", "sphere.png"}
+
+    # Read the colors at the face centroids back from the saved atlas.
+    vt = np.array([
+        [float(value) for value in line.split()[1:]]
+        for line in open(file_path) if line.startswith("vt ")
+    ]).reshape(-1, 3, 2)
+    centroids = vt.mean(axis=1)
+    texels = np.floor(np.stack((centroids[:, 0], 1.0 - centroids[:, 1]), axis=-1) * 256).astype(int)
+    colors = texture[texels[:, 1], texels[:, 0]] / 255.0
+    expected = (vertices[faces].mean(axis=1) * 0.5).clip(0.0, 1.0)
+    assert np.abs(colors - expected).max() < 0.05